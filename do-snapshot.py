@@ -11,114 +11,372 @@ import sys
 import os
 import stat
 import itertools
-import string
+import bisect
+import re
+import time
+import json
+import hashlib
+import tempfile
 import logging
 import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from argparse import ArgumentParser
 
-import requests
+try:
+    # Optional, but decodes large listings several times faster than the stdlib.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+except ImportError:
+    # Only needed to talk to the API, not for --simulate, which can then run under e.g. a
+    # bare PyPy install.
+    requests = None
 
 DO_API_URL_PREFIX = 'https://api.digitalocean.com/v2/'
+# Maximum number of items per page the API allows for listings.
+API_PAGE_SIZE = 200
+# Maximum number of concurrent calls issued by api_many().  Each droplet worker may run a
+# batch, so main() sizes the session's pool to this multiplied by --concurrency.
+API_BATCH_CONCURRENCY = 4
+
 
 log = logging.getLogger('do-snapshot')
 
+EPOCH = datetime(1970, 1, 1)
+
+HEX_RE = re.compile(r'[0-9a-fA-F]+')
+INTERVAL_RE = re.compile(r'(\d+)([dhmw])')
+INTERVAL_UNITS = {
+    'd': timedelta(days=1),
+    'h': timedelta(hours=1),
+    'm': timedelta(days=30),
+    'w': timedelta(weeks=1)
+}
+
 
 def parse_interval(interval):
     """
     Parses a string like '3d' and returns a timedelta object
     """
-    suffixmap = {
-        'd': lambda x: {'days': x},
-        'h': lambda x: {'hours': x},
-        'm': lambda x: {'days': x*30},
-        'w': lambda x: {'weeks': x}
-    }
+    m = INTERVAL_RE.fullmatch(interval)
+    if not m:
+        raise ValueError('invalid interval {!r} (must be a number with suffix m, w, d, or h)'
+                         .format(interval))
+    return INTERVAL_UNITS[m.group(2)] * int(m.group(1))
+
+
+def create_session(pool_size):
+    """
+    Returns a session with connection pooling and retries configured.
+
+    pool_size is the number of connections to keep, which should cover the maximum number
+    of concurrent requests so none are discarded.
+
+    Connections (and TLS handshakes) to the API are reused across calls and worker threads.
+    Transient failures are retried with backoff for idempotent methods only: retrying a POST
+    could take a duplicate snapshot or queue a duplicate transfer.  Once retries are
+    exhausted the last response is returned rather than raising, so api() logs it like any
+    other failure, and a failed DELETE or transfer never stops the snapshot from being taken.
+    """
+    retry_kwargs = dict(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                        raise_on_status=False)
+    methods = frozenset(['GET', 'DELETE'])
     try:
-        kwargs = suffixmap[interval[-1]](int(interval[:-1]))
-    except KeyError:
-        raise ValueError('unsupported interval suffix {}'.format(interval[-1]))
-    except ValueError:
-        raise ValueError('interval must be a number')
-    else:
-        return timedelta(**kwargs)
+        retry = Retry(allowed_methods=methods, **retry_kwargs)
+    except TypeError:
+        # urllib3 older than 1.26 (e.g. as packaged by Debian 10 and Ubuntu 20.04) calls
+        # this method_whitelist.
+        retry = Retry(method_whitelist=methods, **retry_kwargs)
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                          max_retries=retry))
+    return session
+
+
+# Shared session used by api(), created by main() for non-simulated runs so that
+# --simulate never needs requests or urllib3.
+SESSION = None
 
 
-def api(method, token, path, payload=None, dryrun=False):
+def api(method, path, payload=None, dryrun=False, headers=None):
     """
     Simple wrapper for the DO v2 API.
 
-    A 4xx return code will log the error but no exception is raised.  The response object is
-    returned.
+    Requests are made through the shared SESSION, which must have been created and had its
+    Authorization header set before use.
+
+    A 4xx or 5xx return code will log the error but no exception is raised.  The response
+    object is returned.
     """
-    headers = {'Authorization': 'Bearer ' + token}
     url = DO_API_URL_PREFIX + path
     if dryrun:
         log.debug('dryrun: skipping API call: %s %s payload=%s', method, path, payload)
         return
-    r = getattr(requests, method)(url, json=payload, headers=headers)
-    if r.status_code >= 400 and r.status_code < 500:
+    r = SESSION.request(method.upper(), url, json=payload, headers=headers, timeout=(5, 30))
+    if r.status_code >= 400:
         log.error('api call %s failed with status %s: %s', path, r.status_code, r.text)
     return r
 
 
-def ensure_snapshot_regions(args, snapshot, regions):
-    missing = set(regions) - set(snapshot['regions'])
+def api_many(method, calls, dryrun=False):
+    """
+    Issues a batch of independent API calls concurrently.
+
+    DigitalOcean has no bulk endpoints for snapshot deletion or transfer, so this is the
+    next best thing: the calls are spread over a few threads sharing the pooled session.
+
+    calls is a list of (path, payload) tuples.  Returns the list of response objects in the
+    same order.
+    """
+    if not calls:
+        return []
+    if dryrun:
+        # Nothing will be sent, so don't bother with threads (which matters for simulations).
+        return [api(method, *call, dryrun=True) for call in calls]
+    with ThreadPoolExecutor(max_workers=min(API_BATCH_CONCURRENCY, len(calls))) as executor:
+        return list(executor.map(lambda call: api(method, *call, dryrun=dryrun), calls))
+
+
+def cache_file(args, path):
+    """
+    Returns the on-disk cache filename for the given API path, or None if caching is
+    disabled.
+
+    The key includes the token so that different accounts never share cached responses.
+    """
+    if not args.cache_dir or args.cache_ttl <= 0:
+        return None
+    key = hashlib.sha1('{}\0{}'.format(args.token, path).encode()).hexdigest()
+    return os.path.join(args.cache_dir, key + '.json')
+
+
+def cache_load(fname, ttl):
+    """
+    Returns the cached body from fname if it's younger than ttl seconds, otherwise None.
+    """
+    try:
+        if os.path.getmtime(fname) < time.time() - ttl:
+            return None
+        with open(fname, 'rb') as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def cache_store(fname, body):
+    """
+    Atomically writes body to the cache file.  Failures are logged and otherwise ignored,
+    as the cache is purely an optimization.
+    """
+    try:
+        os.makedirs(os.path.dirname(fname), mode=0o700, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(body, f)
+            os.replace(tmpname, fname)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+    except OSError as e:
+        log.debug('unable to write cache file %s: %s', fname, e)
+
+
+def cache_invalidate(fname):
+    try:
+        os.unlink(fname)
+    except OSError:
+        pass
+
+
+def api_get(args, path):
+    """
+    GETs the given API path and returns the decoded body, or None if the request failed
+    (which api() will have logged).
+
+    When caching is enabled, the validators (ETag and Last-Modified) from the previous
+    response are sent along, so an unchanged resource costs a bodyless 304 and the cached
+    body is returned instead.
+    """
+    fname = cache_file(args, path)
+    # Age doesn't matter here: the server decides whether the cached body is still valid.
+    cached = cache_load(fname, float('inf')) if fname else None
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    r = api('get', path, headers=headers)
+    if r.status_code == 304 and cached:
+        log.debug('%s not modified, using cached response', path)
+        return cached['body']
+    if not r.ok:
+        return None
+    body = json_loads(r.content)
+    etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+    if fname and (etag or last_modified):
+        cache_store(fname, {'etag': etag, 'last_modified': last_modified, 'body': body})
+    return body
+
+
+def api_list(args, path, key, ttl):
+    """
+    Returns the list of items under key from a paginated API listing, or None if any page
+    couldn't be fetched.
+
+    The full listing is served from the on-disk cache if one younger than ttl seconds is
+    available.
+    """
+    fname = cache_file(args, path)
+    if fname:
+        items = cache_load(fname, ttl)
+        if items is not None:
+            log.debug('using cached listing for %s', path)
+            return items
+    # The API defaults to 20 items per page; ask for the maximum to minimize round trips.
+    sep = '&' if '?' in path else '?'
+    body = api_get(args, path + sep + 'per_page={}'.format(API_PAGE_SIZE))
+    if body is None:
+        return None
+    items = list(body[key])
+    total = body.get('meta', {}).get('total')
+    if total is not None:
+        # The first page tells us how many pages there are, so fetch the rest concurrently
+        # rather than walking the next links one round trip at a time.
+        pages = [path + sep + 'page={}&per_page={}'.format(n, API_PAGE_SIZE)
+                 for n in range(2, -(-total // API_PAGE_SIZE) + 1)]
+        if pages:
+            with ThreadPoolExecutor(max_workers=min(API_BATCH_CONCURRENCY, len(pages))) as executor:
+                for body in executor.map(lambda page: api_get(args, page), pages):
+                    if body is None:
+                        return None
+                    items.extend(body[key])
+    else:
+        page = body.get('links', {}).get('pages', {}).get('next')
+        while page:
+            if not page.startswith(DO_API_URL_PREFIX):
+                raise ValueError('unexpected next page link {}'.format(page))
+            body = api_get(args, page[len(DO_API_URL_PREFIX):])
+            if body is None:
+                return None
+            items.extend(body[key])
+            page = body.get('links', {}).get('pages', {}).get('next')
+    if fname:
+        cache_store(fname, items)
+    return items
+
+
+def snapshot_transfers(snapshot, regions):
+    """
+    Returns the transfer API calls, as (path, payload) tuples for api_many(), needed to put
+    the snapshot in any of the given regions it's missing from.
+
+    regions is the frozenset built once in main().  The list is empty if the snapshot is
+    already everywhere it should be.
+    """
+    missing = regions.difference(snapshot['regions'])
     if not missing:
         log.debug('snapshot %s is already in required regions (%s)',
                   snapshot['name'], ', '.join(snapshot['regions']))
+    calls = []
     for region in missing:
         log.info('transferring snapshot %s to region %s', snapshot['name'], region)
-        api('post', args.token, 'images/{}/actions'.format(snapshot['id']),
-            {'type': 'transfer', 'region': region}, dryrun=args.dryrun)
+        calls.append(('images/{}/actions'.format(snapshot['id']),
+                      {'type': 'transfer', 'region': region}))
+    return calls
+
+
+def timestamp(dt):
+    """
+    Returns the given naive UTC datetime as integer seconds since the epoch.
+    """
+    return int((dt - EPOCH).total_seconds())
+
+
+def snapshot_ts(snapshot):
+    """
+    Returns the snapshot's creation time as integer seconds since the epoch.
+
+    Retention works in plain integer seconds, which is much cheaper than datetime and
+    timedelta arithmetic.  Simulations pass the same snapshots through retention repeatedly,
+    so the parsed time is cached on the snapshot the first time it's needed.
+    """
+    if '_ts' not in snapshot:
+        snapshot['_ts'] = timestamp(datetime.fromisoformat(snapshot['created_at'][:19]))
+    return snapshot['_ts']
 
 
 def apply_retention_policies(args, snapshots, policies, now):
-    # Create a dictionary of snapshots by id -- we remove from it for each
-    # deleted snapshot so we can return a final set of survivors
-    snapshots_by_id = dict((snapshot['id'], snapshot) for snapshot in snapshots)
     # Sort snapshots from oldest to newest.
     snapshots.sort(key=lambda s: s['created_at'])
-    # Group snapshots by applicable policy
+    if not policies:
+        # Nothing to delete.
+        return list(snapshots)
+    # Policies are sorted oldest age first, so reverse them to get ascending ages we can
+    # bisect.  The applicable policy for a snapshot is the one with the largest age not
+    # exceeding the snapshot's age.
+    ascending = policies[::-1]
+    ages = [age.total_seconds() for _, age in ascending]
+    now_ts = timestamp(now)
+    # Group snapshots by applicable policy.  Every snapshot starts out kept, and is flagged
+    # otherwise when deleted below so we can return a final set of survivors.
     snapshots_by_policy = {}
     for snapshot in snapshots:
-        snapshot_time = datetime.strptime(snapshot['created_at'][:19], '%Y-%m-%dT%H:%M:%S')
-        snapshot_age = now - snapshot_time
-        snapshot['created_dt'] = snapshot_time
-        snapshot['age'] = snapshot_age
-        for interval, age in policies:
-            if snapshot_age >= age:
-                # This snapshot is older than the age for this policy, so it applies.
-                snapshots_by_policy.setdefault((interval, age), []).append(snapshot)
-                break
-
-    # Apply retention policies
-    for (interval, age), snapshots in snapshots_by_policy.items():
+        snapshot['_kept'] = True
+        snapshot_age = now_ts - snapshot_ts(snapshot)
+        idx = bisect.bisect_right(ages, snapshot_age) - 1
+        if idx >= 0:
+            # This snapshot is older than the age for this policy, so it applies.
+            snapshots_by_policy.setdefault(ascending[idx], []).append(snapshot)
+
+    # Apply retention policies, collecting the snapshots to delete so the API calls can
+    # be issued together afterward.
+    to_delete = []
+    for (interval, age), group in snapshots_by_policy.items():
         # We need to iterate over the snapshots from oldest to newest (the current order) so
         # we prefer older snapshots, which is necessary to allow snapshots to age through their
         # policy group.
+        interval_secs = interval.total_seconds()
         last_kept = None
-        for snapshot in (snapshots):
+        for snapshot in group:
+            since_kept = snapshot['_ts'] - last_kept if last_kept is not None else None
             log.debug('considering snapshot %s: age %s', snapshot['name'],
-                      snapshot['created_dt'] - last_kept if last_kept else None)
-            if not interval or (last_kept and snapshot['created_dt'] - last_kept < interval):
+                      timedelta(seconds=since_kept) if since_kept is not None else None)
+            if not interval_secs or (since_kept is not None and since_kept < interval_secs):
                 log.info('deleting snapshot %s by policy (keep snapshot every %s if older than %s)',
                          snapshot['name'], interval, age)
-                api('delete', args.token, 'snapshots/{}'.format(snapshot['id']), dryrun=args.dryrun)
-                del snapshots_by_id[snapshot['id']]
+                to_delete.append(snapshot)
+                snapshot['_kept'] = False
             else:
                 log.debug('preserving snapshot %s', snapshot['name'])
-                last_kept = snapshot['created_dt']
+                last_kept = snapshot['_ts']
+    api_many('delete', [('snapshots/{}'.format(snapshot['id']), None) for snapshot in to_delete],
+             dryrun=args.dryrun)
 
-    # Return survivors
-    return sorted(snapshots_by_id.values(), key=lambda s: s['created_at'])
+    # Return survivors, which are still sorted oldest to newest
+    return [snapshot for snapshot in snapshots if snapshot['_kept']]
 
 
-def process_droplet(args, droplet, snapshots, policies, min_age, prefix, now):
+def snapshot_name_fmt(prefix):
+    """
+    Returns the strftime format for naming snapshots with the given prefix.
+    """
+    return prefix + '%Y%m%dT%H%M%SZ'
+
+
+def process_droplet(args, droplet, snapshots, policies, min_age, name_fmt, now):
     """
     Do all the things.  Delete obsolete snapshots, transfer remaining snapshots to
     desired regions, and take a new snapshot if it's time.
 
+    name_fmt is the strftime format for the name of a new snapshot (see snapshot_name_fmt()).
+
     Returns a tuple of remaining snapshots, and snapshot name if one was taken,
     otherwise None.
     """
@@ -128,23 +386,32 @@ def process_droplet(args, droplet, snapshots, policies, min_age, prefix, now):
     # Remove obsolete snapshots
     survivors = apply_retention_policies(args, snapshots, policies, now)
 
-    # Transfer snapshots missing from regions
+    # Transfer snapshots missing from regions, issuing all the transfers for this droplet
+    # together.
     if args.region:
+        transfers = []
         for snapshot in survivors:
-            ensure_snapshot_regions(args, snapshot, args.region)
-            # In case we are running a simulation, update 
-            snapshot['regions'] = list(set(snapshot['regions']).union(args.region))
-
-    # Finally take a new snapshot if needed
-    if not snapshots or snapshots[-1]['age'] >= min_age:
-        snapshot_name = now.strftime(prefix + '%Y%m%dT%H%M%SZ')
+            calls = snapshot_transfers(snapshot, args.region)
+            if calls:
+                transfers.extend(calls)
+                # In case we are running a simulation, update the snapshot's regions.  This
+                # only happens the first time through for a given snapshot, so simulations
+                # don't rebuild every surviving snapshot's region list on every tick.
+                snapshot['regions'] = list(args.region.union(snapshot['regions']))
+        api_many('post', transfers, dryrun=args.dryrun)
+
+    # Finally take a new snapshot if needed.  Snapshots were sorted oldest to newest by
+    # apply_retention_policies(), so only the most recent one's age matters.
+    latest_age = timestamp(now) - snapshot_ts(snapshots[-1]) if snapshots else None
+    if not snapshots or latest_age >= min_age.total_seconds():
+        snapshot_name = now.strftime(name_fmt)
         log.info('snapshotting droplet %s -> %s', droplet['name'], snapshot_name)
-        r = api('post', args.token, 'droplets/{}/actions'.format(droplet['id']),
+        r = api('post', 'droplets/{}/actions'.format(droplet['id']),
             {'type': 'snapshot', 'name': snapshot_name}, dryrun=args.dryrun)
         if r:
-            log.debug('snapshot response: %s', r.json())
+            log.debug('snapshot response: %s', json_loads(r.content))
     else:
-        log.info('skipping snapshot, most recent is %s old', snapshots[-1]['age'])
+        log.info('skipping snapshot, most recent is %s old', timedelta(seconds=latest_age))
         snapshot_name = None
     return survivors, snapshot_name
 
@@ -163,6 +430,8 @@ def main():
     p.add_argument('-k', '--keep', dest='keep', metavar='INTERVAL:AGE', action='append', default=[],
                    help='keeps one snapshot per INTERVAL if older than AGE, deleting others '
                         ' (supports multiple -k to build a retention policy)')
+    p.add_argument('-j', '--concurrency', dest='concurrency', metavar='N', type=int, default=8,
+                   help='number of droplets to process in parallel (default: 8)')
     p.add_argument('--dryrun', dest='dryrun', action='store_true', default=False,
                    help="don't actually take or delete or transfer any snapshots")
     p.add_argument('--token', dest='token', action='store',
@@ -171,6 +440,11 @@ def main():
     p.add_argument('--simulate', dest='simulate', metavar='INTERVAL:DURATION',
                    help='Test a retention policy (multiple -k) by runs of the tool'
                         'every INTERVAL for DURATION time.  (Implies --dryrun)')
+    p.add_argument('--cache-dir', dest='cache_dir', metavar='DIR', default='~/.cache/do-snapshot',
+                   help='directory for caching API listings (default: ~/.cache/do-snapshot)')
+    p.add_argument('--cache-ttl', dest='cache_ttl', metavar='SECONDS', type=int, default=300,
+                   help='reuse cached droplet listings younger than SECONDS, and snapshot '
+                        'listings younger than a fifth of that (default: 300, 0 disables)')
     p.add_argument('--syslog', dest='syslog', action='store_true', default=False,
                    help='log to syslog instead of stderr')
     p.add_argument('-v', '--verbose', dest='verbose', action='store_true',
@@ -198,28 +472,43 @@ def main():
         args.token = os.getenv('DO_TOKEN')
     else:
         fname = os.path.expanduser(args.token)
-        if os.path.exists(fname):
-            # Token is actually a filename, so read it.
-            args.token = open(fname).read().strip()
+        try:
+            f = open(fname)
+        except FileNotFoundError:
+            # Not a filename, so it's the token itself.
+            pass
+        else:
+            # Token is actually a filename, so read it.  Permissions are checked on the
+            # opened file itself rather than stat()ing the path again.
+            with f:
+                mode = os.fstat(f.fileno()).st_mode
+                args.token = f.read().strip()
             if not sys.platform.startswith('win'):
                 # Sanity check permissions on token file.
-                mode = os.stat(fname).st_mode
                 if mode & stat.S_IROTH or mode & stat.S_IRGRP:
                     log.warning('token file %s is readable by group or other', fname)
 
     if not args.token:
         return log.fatal('must pass API token via --token or DO_TOKEN environment variable')
     elif not args.token.startswith('dop_'):
-        if len(args.token) in (32, 64) and all(c in string.hexdigits for c in args.token):
+        if len(args.token) in (32, 64) and HEX_RE.fullmatch(args.token):
             log.warning('using legacy token -- recommend regenerating a personal access token')
         else:
             log.warning('token looks invalid')
 
+    if not args.simulate:
+        if not requests:
+            return log.fatal('the requests module is required (pip install requests)')
+        global SESSION
+        SESSION = create_session(max(1, args.concurrency) * API_BATCH_CONCURRENCY)
+        SESSION.headers['Authorization'] = 'Bearer ' + args.token
+
     args.prefix = args.prefix.replace('$tag', args.tag).strip()
     min_age = parse_interval(args.snapshot)
     log.info('will snapshot if latest is older than %s', min_age)
-    args.region = [r.strip() for r in args.region]
+    args.region = frozenset(r.strip() for r in args.region)
     args.tag = args.tag.strip()
+    args.cache_dir = os.path.expanduser(args.cache_dir)
 
     policies = []
     if args.keep:
@@ -244,20 +533,55 @@ def main():
 
     if not args.simulate:
         # Enumerate all droplets matching the supplied tag
-        r = api('get', args.token, 'droplets?tag_name=' + args.tag)
-        droplets = r.json()['droplets']
+        droplets_path = 'droplets?tag_name=' + args.tag
+        droplets = api_list(args, droplets_path, 'droplets', args.cache_ttl)
+        if droplets is None:
+            log.fatal('unable to list droplets with tag %s', args.tag)
+            sys.exit(1)
         log.info('%d droplets found with tag %s', len(droplets), args.tag)
-        for droplet in droplets:
-            r = api('get', args.token, 'droplets/{}/snapshots'.format(droplet['id']))
+
+        def handle_droplet(droplet):
+            """
+            Returns False if the droplet had to be skipped, otherwise True.
+            """
+            # Snapshots change more often than droplets, so use a shorter TTL.
+            path = 'droplets/{}/snapshots'.format(droplet['id'])
             # Filter out non-autosnapshots
             prefix = args.prefix.replace('$droplet', droplet['name'])
-            snapshots = [snapshot for snapshot in r.json()['snapshots'] if prefix in snapshot['name']]
+            listing = api_list(args, path, 'snapshots', args.cache_ttl / 5)
+            if listing is None:
+                # Most likely a 404 because the droplet was destroyed since the droplet
+                # listing was cached, so drop that listing for the next run.
+                log.warning('skipping droplet %s: unable to list its snapshots', droplet['name'])
+                fname = cache_file(args, droplets_path)
+                if fname:
+                    cache_invalidate(fname)
+                return False
+            snapshots = [snapshot for snapshot in listing if snapshot['name'].startswith(prefix)]
             log.info('%d autosnapshots found for droplet %s', len(snapshots), droplet['name'])
-            process_droplet(args, droplet, snapshots, policies, min_age, prefix, now)
+            survivors, snapshot_name = process_droplet(args, droplet, snapshots, policies, min_age,
+                                                       snapshot_name_fmt(prefix), now)
+            if not args.dryrun and (snapshot_name or len(survivors) < len(snapshots) or args.region):
+                # We (may have) changed this droplet's snapshots, so the cached listing is
+                # now stale.
+                fname = cache_file(args, path)
+                if fname:
+                    cache_invalidate(fname)
+            return True
+
+        # Droplets are independent of one another and the work is dominated by API round
+        # trips, so process them concurrently.  Consuming the results re-raises any exception
+        # from the worker threads.
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+            # Materialize the results so every droplet is processed before checking them.
+            results = list(executor.map(handle_droplet, droplets))
+        if not all(results):
+            log.error('%d of %d droplets were skipped', results.count(False), len(results))
+            sys.exit(1)
     else:
         # Dummy droplet for the simulation
         droplet = {'id': 0, 'name': 'simulated'}
-        prefix = args.prefix.replace('$droplet', droplet['name'])
+        name_fmt = snapshot_name_fmt(args.prefix.replace('$droplet', droplet['name']))
         try:
             interval, duration = args.simulate.split(':')
         except ValueError:
@@ -269,20 +593,22 @@ def main():
         while now < end:
             snapshot_id = next(idgen)
             log.info('--- simulation %d at %s', snapshot_id, now)
-            snapshots, newsnapshot = process_droplet(args, droplet, snapshots, policies, min_age, prefix, now)
+            snapshots, newsnapshot = process_droplet(args, droplet, snapshots, policies, min_age, name_fmt, now)
             if newsnapshot:
                 snapshots.append({
                     'id': snapshot_id,
                     'name': newsnapshot,
                     'created_at': now.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    '_ts': timestamp(now),
                     'regions': []
                 })
             now += interval
         log.info('%s remaining snapshots (below) after %s', len(snapshots), duration)
-        print('Time'.ljust(23), 'Name')
-        print('-' * 23, '-' * 50)
-        for snapshot in snapshots:
-            print(snapshot['created_at'].ljust(23), snapshot['name'])
+        # Build the whole report and write it at once rather than a print() per snapshot.
+        lines = ['{:<23} {}'.format('Time', 'Name'), '{} {}'.format('-' * 23, '-' * 50)]
+        lines.extend('{:<23} {}'.format(snapshot['created_at'], snapshot['name'])
+                     for snapshot in snapshots)
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 
 if __name__ == '__main__':